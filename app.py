@@ -1,43 +1,139 @@
-from flask import Flask, request, jsonify
+from contextlib import contextmanager
+from flask import Flask, Response, request
+import bisect
 import mediapipe as mp
 import numpy as np
 import cv2
+import orjson
+import os
+import queue
+import threading
 
 app = Flask(__name__)
-pose = mp.solutions.pose.Pose(static_image_mode=True)
+
+# Uploads are usually unrelated photos, so every image gets a full detection pass.
+# Set POSE_TRACKING=1 when frames come from a single camera feed to let MediaPipe
+# track the previous ROI instead of re-running the person detector each time.
+POSE_TRACKING = os.environ.get("POSE_TRACKING", "0") == "1"
+POSE_OPTIONS = {
+    "static_image_mode": not POSE_TRACKING,
+    # 0 = Lite landmark model, roughly 3x faster on CPU; raise for finer landmarks
+    "model_complexity": int(os.environ.get("POSE_MODEL_COMPLEXITY", "0")),
+}
+if POSE_TRACKING:
+    # looser thresholds keep the tracker locked on between frames
+    POSE_OPTIONS.update(min_detection_confidence=0.4, min_tracking_confidence=0.4)
+
+# Only the Full landmark model ships in the mediapipe wheel; Lite/Heavy are downloaded on
+# first use. Fetch it here, once, before gunicorn forks workers or threads race on a
+# half-written file. This is a no-op when the model is already present (the Docker image
+# downloads it at build time).
+if POSE_OPTIONS["model_complexity"] != 1:
+    mp.solutions.pose._download_oss_pose_landmark_model(POSE_OPTIONS["model_complexity"])
+
+# Pose graphs aren't safe to share between threads, and the dev server spawns a fresh
+# thread per request, so keep built graphs in a pool and lend one out per request
+_pose_pool = queue.SimpleQueue()
+
+# Tracking state lives inside a graph, so in tracking mode every frame goes through
+# the same one; requests queue on the lock instead of spreading across the pool
+_tracking_pose = None
+_tracking_lock = threading.Lock()
+
+@contextmanager
+def borrow_pose():
+    global _tracking_pose
+    if POSE_TRACKING:
+        with _tracking_lock:
+            if _tracking_pose is None:
+                _tracking_pose = mp.solutions.pose.Pose(**POSE_OPTIONS)
+            yield _tracking_pose
+        return
+
+    try:
+        pose = _pose_pool.get_nowait()
+    except queue.Empty:
+        pose = mp.solutions.pose.Pose(**POSE_OPTIONS)
+    try:
+        yield pose
+    finally:
+        _pose_pool.put(pose)
+
+# Longest side (px) of the frame handed to MediaPipe; larger uploads are downscaled first
+MAX_POSE_SIDE = 640
+
+# Decoder flags for the opt-in ?reduce= query parameter on /analyze
+REDUCED_DECODE = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4}
 
 # ✅ drop these from the output entirely
-EXCLUDED_LANDMARKS = {
+EXCLUDED_LANDMARKS = frozenset((
     "left_ankle", "left_foot_index", "left_heel", "left_knee",
     "right_ankle", "right_foot_index", "right_heel", "right_knee"
+))
+
+# Landmark names are fixed by the model, so resolve them once instead of per request.
+# The hot path dispatches on the enum's integer values and only touches names for output.
+_PL = mp.solutions.pose.PoseLandmark
+LANDMARK_NAMES = tuple(_PL(i).name.lower() for i in range(len(_PL)))
+EXCLUDED_IDX = frozenset(_PL[n.upper()].value for n in EXCLUDED_LANDMARKS)
+# (index, name) for every landmark that makes it into the response, filtered up front
+KEPT_LANDMARKS = tuple((i, n) for i, n in enumerate(LANDMARK_NAMES) if i not in EXCLUDED_IDX)
+
+# Only consider these as "key landmarks" for accuracy (upper body)
+KEY_IDX = {
+    "nose": _PL.NOSE.value,
+    "left_shoulder": _PL.LEFT_SHOULDER.value,
+    "right_shoulder": _PL.RIGHT_SHOULDER.value,
+    "left_hip": _PL.LEFT_HIP.value,
+    "right_hip": _PL.RIGHT_HIP.value,
 }
 
-def calc_distance(p1, p2):
-    if not p1 or not p2:
-        return None
-    try:
-        dx = (p1.get("x", 0) - p2.get("x", 0))
-        dy = (p1.get("y", 0) - p2.get("y", 0))
-        return int(np.sqrt(dx * dx + dy * dy))
-    except Exception:
-        return None
+_HEX = tuple(f'{i:02x}' for i in range(256))
+
+# Tone bands, darkest first. A brightness strictly above THRESH[k] lands in LABEL[k + 1],
+# which is what bisect_left gives us (a value equal to a threshold stays in the lower band).
+_FITZPATRICK_THRESH = (100, 130, 160, 190, 210)
+_FITZPATRICK_LABEL = (
+    ("VI", "Very Dark - Never burns, deeply pigmented"),
+    ("V", "Dark - Very rarely burns, tans very easily"),
+    ("IV", "Moderate - Rarely burns, always tans"),
+    ("III", "Light - Sometimes burns, gradually tans"),
+    ("II", "Fair - Usually burns, tans minimally"),
+    ("I", "Very Fair - Always burns, never tans"),
+)
+_DESCR_THRESH = (100, 115, 130, 145, 160, 175, 190, 205, 220)
+_DESCR_LABEL = ('Ebony', 'Rich', 'Deep', 'Tan', 'Medium-Tan', 'Medium',
+                'Light-Medium', 'Light', 'Fair', 'Porcelain')
+_SIMPLE_THRESH = (80, 100, 120, 140, 160, 180, 200, 220)
+_SIMPLE_LABEL = ('Very Dark', 'Deep', 'Dark', 'Medium Dark', 'Medium',
+                 'Light Medium', 'Fair', 'Light', 'Very Light')
+
+# (left, right) landmark index pairs measured by calc_body_width: shoulders, then hips
+_WIDTH_PAIRS = np.array([
+    (KEY_IDX['left_shoulder'], KEY_IDX['right_shoulder']),
+    (KEY_IDX['left_hip'], KEY_IDX['right_hip']),
+])
+
+def calc_body_width(pts):
+    """Shoulder and hip widths from the (33, 2) pixel landmark array, in one vector op"""
+    diffs = pts[_WIDTH_PAIRS[:, 0]] - pts[_WIDTH_PAIRS[:, 1]]
+    shoulder_width, hip_width = np.hypot(diffs[:, 0], diffs[:, 1]).astype(int).tolist()
+    if not shoulder_width or not hip_width:
+        return {"error": "Missing landmarks"}
+
+    ratio = round(shoulder_width / hip_width, 2)
+    return {
+        "shoulder_px": shoulder_width,
+        "hip_px": hip_width,
+        "shoulder_to_hip_ratio": ratio,
+        "body_shape": "Inverted Triangle" if ratio > 1.2 else "Pear" if ratio < 0.8 else "Rectangle"
+    }
 
 def classify_fitzpatrick_scale(r, g, b):
     """Classify skin tone using Fitzpatrick scale (I-VI)"""
     brightness = (r + g + b) / 3
-    
-    if brightness > 210:
-        return {"scale": "I", "description": "Very Fair - Always burns, never tans"}
-    elif brightness > 190:
-        return {"scale": "II", "description": "Fair - Usually burns, tans minimally"}
-    elif brightness > 160:
-        return {"scale": "III", "description": "Light - Sometimes burns, gradually tans"}
-    elif brightness > 130:
-        return {"scale": "IV", "description": "Moderate - Rarely burns, always tans"}
-    elif brightness > 100:
-        return {"scale": "V", "description": "Dark - Very rarely burns, tans very easily"}
-    else:
-        return {"scale": "VI", "description": "Very Dark - Never burns, deeply pigmented"}
+    scale, description = _FITZPATRICK_LABEL[bisect.bisect_left(_FITZPATRICK_THRESH, brightness)]
+    return {"scale": scale, "description": description}
 
 def detect_undertone(r, g, b):
     """Detect skin undertone (warm, cool, neutral)"""
@@ -48,7 +144,7 @@ def detect_undertone(r, g, b):
     # Analyze undertone based on color ratios
     if yellow_factor > 1.15 and red_factor > 1.1:
         return {"undertone": "Warm", "description": "Golden, yellow, or peach undertones"}
-    elif yellow_factor < 0.95 and (b / r) > 0.85:
+    elif yellow_factor < 0.95 and (b / r if r > 0 else float('inf')) > 0.85:
         return {"undertone": "Cool", "description": "Pink, red, or blue undertones"}
     else:
         return {"undertone": "Neutral", "description": "Balanced warm and cool undertones"}
@@ -58,42 +154,26 @@ def get_descriptive_category(r, g, b):
     brightness = (r + g + b) / 3
     
     # More granular categories based on fashion/beauty industry standards
-    if brightness > 220:
-        return "Porcelain"
-    elif brightness > 205:
-        return "Fair"
-    elif brightness > 190:
-        return "Light"
-    elif brightness > 175:
-        return "Light-Medium"
-    elif brightness > 160:
-        return "Medium"
-    elif brightness > 145:
-        return "Medium-Tan"
-    elif brightness > 130:
-        return "Tan"
-    elif brightness > 115:
-        return "Deep"
-    elif brightness > 100:
-        return "Rich"
-    else:
-        return "Ebony"
+    return _DESCR_LABEL[bisect.bisect_left(_DESCR_THRESH, brightness)]
 
-def extract_skin_color(image, landmarks, h, w):
+def extract_skin_color(image, landmarks, h, w, reduce=1):
     try:
-        face_points = []
-        for landmark_name in ['nose', 'left_eye', 'right_eye']:
-            if landmark_name in landmarks:
-                lm = landmarks[landmark_name]
-                face_points.append((int(lm['x']), int(lm['y'])))
+        cx = cy = n = 0
+        for landmark_name in ('nose', 'left_eye', 'right_eye'):
+            lm = landmarks.get(landmark_name)
+            if lm:
+                cx += lm['x']
+                cy += lm['y']
+                n += 1
 
-        if not face_points:
+        if not n:
             return {"error": "No face landmarks for skin detection"}
 
-        center_x = int(np.mean([p[0] for p in face_points]))
-        center_y = int(np.mean([p[1] for p in face_points]))
+        # landmarks are in full-resolution pixels; map them onto the (possibly reduced) image
+        center_x, center_y = int(cx / n / reduce), int(cy / n / reduce)
 
-        region_size = 30
+        # keep the sampled patch the same size relative to the face
+        region_size = 30 // reduce
         x1, x2 = max(0, center_x - region_size), min(w, center_x + region_size)
         y1, y2 = max(0, center_y - region_size), min(h, center_y + region_size)
 
@@ -101,11 +181,11 @@ def extract_skin_color(image, landmarks, h, w):
         if face_region.size == 0:
             return {"error": "Empty region for skin color"}
 
-        face_rgb = cv2.cvtColor(face_region, cv2.COLOR_BGR2RGB)
-        avg_color = np.mean(face_rgb, axis=(0, 1))
+        # image is decoded straight to RGB, so the channel means are already in order
+        r, g, b, _ = cv2.mean(face_region)
 
-        hex_color = '#{:02x}{:02x}{:02x}'.format(*[int(c) for c in avg_color])
-        r, g, b = avg_color
+        ir, ig, ib = int(r) & 0xff, int(g) & 0xff, int(b) & 0xff
+        hex_color = '#' + _HEX[ir] + _HEX[ig] + _HEX[ib]
         
         # Get all classification systems
         fitzpatrick = classify_fitzpatrick_scale(r, g, b)
@@ -114,116 +194,126 @@ def extract_skin_color(image, landmarks, h, w):
         
         # Detailed simple tone categories
         brightness = (r + g + b) / 3
-        
-        if brightness > 220:
-            simple_tone = "Very Light"
-        elif brightness > 200:
-            simple_tone = "Light"
-        elif brightness > 180:
-            simple_tone = "Fair"
-        elif brightness > 160:
-            simple_tone = "Light Medium"
-        elif brightness > 140:
-            simple_tone = "Medium"
-        elif brightness > 120:
-            simple_tone = "Medium Dark"
-        elif brightness > 100:
-            simple_tone = "Dark"
-        elif brightness > 80:
-            simple_tone = "Deep"
-        else:
-            simple_tone = "Very Dark"
+        simple_tone = _SIMPLE_LABEL[bisect.bisect_left(_SIMPLE_THRESH, brightness)]
 
         return {
             "hex": hex_color, 
-            "rgb": [int(r), int(g), int(b)], 
+            "rgb": [ir, ig, ib], 
             "tone_category": simple_tone,  # Keep for backward compatibility
             "descriptive_category": descriptive,
             "fitzpatrick_scale": fitzpatrick,
             "undertone": undertone,
-            "brightness_score": round((r + g + b) / 3, 1)
+            "brightness_score": round(brightness, 1)
         }
     except Exception as e:
         return {"error": f"Skin extraction failed: {str(e)}"}
 
+def json_response(payload, status=200):
+    """Serialize with orjson instead of jsonify; the keypoint payload is float-heavy.
+    Keys stay sorted so the output matches what jsonify produced."""
+    return Response(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS),
+                    status=status, mimetype='application/json')
+
 @app.route('/analyze', methods=['POST'])
 def analyze():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file uploaded'}), 400
+    # Raw image bodies skip multipart parsing entirely; form uploads still work as before
+    if request.mimetype.startswith('image/'):
+        buf = request.get_data(cache=False)
+    elif 'file' in request.files:
+        buf = request.files['file'].read()
+    else:
+        return json_response({'error': 'No file uploaded'}, 400)
+
+    if not buf:
+        return json_response({'error': 'Uploaded file is empty'}, 400)
 
-    file = request.files['file']
-    file_bytes = np.frombuffer(file.read(), np.uint8)
-    image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
+    # ?reduce=2|4 lets callers with large photos have the decoder produce a smaller image
+    reduce_arg = request.args.get('reduce', '1')
+    if reduce_arg not in ('1', '2', '4'):
+        return json_response({'error': 'reduce must be 1, 2 or 4'}, 400)
+    reduce = int(reduce_arg)
 
-    result = pose.process(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-    keypoints = {}
+    # frombuffer is a zero-copy view over buf, which stays alive through imdecode
+    file_bytes = np.frombuffer(buf, np.uint8)
+    if reduce == 1:
+        # MediaPipe wants RGB; decoding straight to RGB (OpenCV >= 4.10) skips a full-frame cvtColor
+        image = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR_RGB)
+    else:
+        image = cv2.imdecode(file_bytes, REDUCED_DECODE[reduce])
+
+    if image is None:
+        return json_response({'error': 'Uploaded file is not a readable image'}, 400)
+
+    if reduce != 1:
+        # reduced decodes only come out as BGR, but converting the smaller frame is cheap
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+    # MediaPipe resizes to 256x256 internally, so don't feed it more pixels than it needs.
+    # Landmarks come back normalized, so they still map onto the full-size image below.
+    h, w, _ = image.shape
+    scale = max(h, w) / MAX_POSE_SIDE
+    pose_input = image
+    if scale > 1:
+        # clamp so a very elongated image never rounds a side down to 0 px
+        pose_input = cv2.resize(image, (max(1, int(w / scale)), max(1, int(h / scale))),
+                                interpolation=cv2.INTER_AREA)
+
+    with borrow_pose() as pose:
+        result = pose.process(pose_input)
     analysis_accuracy = {}
 
     if result.pose_landmarks:
-        h, w, _ = image.shape
-
-        # Only consider these as "key landmarks" for accuracy (upper body)
-        key_landmarks = ['nose', 'left_shoulder', 'right_shoulder', 'left_hip', 'right_hip']
-
-        for i, lm in enumerate(result.pose_landmarks.landmark):
-            name = mp.solutions.pose.PoseLandmark(i).name.lower()
-            # 🚫 skip excluded lower-body points
-            if name in EXCLUDED_LANDMARKS:
-                continue
-
-            keypoints[name] = {
-                "x": int(lm.x * w),
-                "y": int(lm.y * h),
-                "z": lm.z,
-                "visibility": lm.visibility
+        # one pass over the landmarks, then scale every coordinate at once
+        arr = np.array([(lm.x, lm.y, lm.z, lm.visibility)
+                        for lm in result.pose_landmarks.landmark], dtype=np.float64)
+        # report pixels at the uploaded resolution even when decoding was reduced
+        pts = (arr[:, :2] * (w * reduce, h * reduce)).astype(np.int32)
+        xs = pts[:, 0].tolist()
+        ys = pts[:, 1].tolist()
+        zs = arr[:, 2].tolist()
+        vis = arr[:, 3].tolist()
+
+        # 🚫 skip excluded lower-body points
+        keypoints = {
+            name: {"x": xs[i], "y": ys[i], "z": zs[i], "visibility": vis[i]}
+            for i, name in KEPT_LANDMARKS
+        }
+
+        for name, i in KEY_IDX.items():
+            v = vis[i]
+            analysis_accuracy[name] = {
+                "visibility": round(v, 5),
+                "confidence": "High" if v > 0.8 else "Medium" if v > 0.5 else "Low"
             }
 
-            if name in key_landmarks:
-                analysis_accuracy[name] = {
-                    "visibility": round(lm.visibility, 5),
-                    "confidence": "High" if lm.visibility > 0.8 else "Medium" if lm.visibility > 0.5 else "Low"
-                }
-
-        # --- Body width (kept as-is) ---
-        body_width_data = {"error": "Missing landmarks"}
-        if keypoints.get('left_shoulder') and keypoints.get('right_shoulder'):
-            shoulder_width = calc_distance(keypoints['left_shoulder'], keypoints['right_shoulder'])
-            if keypoints.get('left_hip') and keypoints.get('right_hip'):
-                hip_width = calc_distance(keypoints['left_hip'], keypoints['right_hip'])
-                if shoulder_width and hip_width and hip_width > 0:
-                    ratio = round(shoulder_width / hip_width, 2)
-                    body_width_data = {
-                        "shoulder_px": shoulder_width,
-                        "hip_px": hip_width,
-                        "shoulder_to_hip_ratio": ratio,
-                        "body_shape": "Inverted Triangle" if ratio > 1.2 else "Pear" if ratio < 0.8 else "Rectangle"
-                    }
+        # --- Body width ---
+        body_width_data = calc_body_width(pts)
 
         # accuracy score (upper-body only)
-        visible_landmarks = [kp for kp in key_landmarks if kp in keypoints and keypoints[kp]['visibility'] > 0.5]
-        overall_confidence = len(visible_landmarks) / len(key_landmarks)
+        visible_landmarks = [kp for kp, i in KEY_IDX.items() if vis[i] > 0.5]
+        overall_confidence = len(visible_landmarks) / len(KEY_IDX)
 
-        return jsonify({
+        return json_response({
             "keypoints": keypoints,
-            "skin_color": extract_skin_color(image, keypoints, h, w),
+            "skin_color": extract_skin_color(image, keypoints, h, w, reduce),
             "body_width": body_width_data,
             "model_accuracy": {
                 "overall_confidence": round(overall_confidence, 2),
                 "key_landmarks_detected": len(visible_landmarks),
-                "total_key_landmarks": len(key_landmarks),
+                "total_key_landmarks": len(KEY_IDX),
                 "landmark_accuracy": analysis_accuracy
             }
         })
 
     else:
-        return jsonify({
+        return json_response({
             "keypoints": {},
             "skin_color": {"error": "No face detected"},
             "body_width": {"error": "No pose detected"},
             "model_accuracy": {
                 "overall_confidence": 0.0,
                 "key_landmarks_detected": 0,
-                "total_key_landmarks": 5,
+                "total_key_landmarks": len(KEY_IDX),
                 "landmark_accuracy": {}
             }
         })
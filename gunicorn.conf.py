@@ -0,0 +1,18 @@
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "5000")
+
+# MediaPipe Pose runs inference on a single core, so scale out with workers. The host CPU
+# count says nothing about a container's CPU limit and every worker loads its own graphs,
+# so start small and set WEB_CONCURRENCY to the cores the deployment actually gets.
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "2"))
+
+# Tracking state lives in a single in-process graph, so it only holds up with one worker
+if os.environ.get("POSE_TRACKING", "0") == "1":
+    workers = 1
+
+# Import app.py (MediaPipe, OpenCV, landmark tables) once in the master so workers share
+# those pages copy-on-write. No Pose graph exists at import time - borrow_pose() builds
+# them lazily inside each worker, so no MediaPipe threads are created before the fork.
+preload_app = True